@@ -3,9 +3,14 @@ Glamira Product Crawler with Selenium
 Crawls: product_name, price, currency, category, image_url, rating, url, domain
 """
 
+import asyncio
+import atexit
+import io
 import logging
+import multiprocessing
+import os
+import random
 import sys
-import json
 import time
 import bson
 import re
@@ -13,6 +18,9 @@ from pathlib import Path
 from datetime import datetime
 from urllib.parse import urlparse
 
+import aiohttp
+import orjson
+import requests
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
@@ -25,6 +33,9 @@ from bs4 import BeautifulSoup
 
 from pymongo import MongoClient
 
+# Without the C extension every product pays a pure-Python BSON encode
+assert bson.has_c(), "pymongo was installed without C extensions - reinstall with them"
+
 
 # CONFIGURATION
 
@@ -47,15 +58,34 @@ OUTPUT_PRODUCT_IDS = './output/unique_product_ids.json'
 OUTPUT_BSON = './output/product_details.bson'
 OUTPUT_JSON = './output/product_details.json'
 OUTPUT_RESUME = './output/product_crawl_state.json'
+OUTPUT_PROCESSED_LOG = './output/processed_products.txt'
 LOG_FILE = './logs/product_crawler.log'
 
 # Crawling configuration
 BATCH_SIZE = 50  # Smaller batch for Selenium
 PAGE_LOAD_TIMEOUT = 30  # Increased timeout
 ELEMENT_WAIT_TIMEOUT = 20  # Wait for elements
-DELAY_BETWEEN_PRODUCTS = 2  # Seconds between products
-DELAY_BETWEEN_BATCHES = 5
-MAX_RETRIES_PER_PRODUCT = 2  # Retry failed products
+PER_DOMAIN_DELAY = 0.5  # Seconds between requests to the same country domain
+MAX_RETRIES_PER_PRODUCT = 3  # Attempts per product in the retry pass
+RETRY_PAGE_LOAD_TIMEOUT = 60  # Patient timeout for the dedicated retry driver
+DRIVER_RESTART_NAVIGATIONS = 500  # Recycle Chrome before memory bloat sets in
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+# Async HTTP-first configuration (Selenium is only the JS fallback)
+HTTP_BATCH_SIZE = 500  # Products per asyncio batch
+HTTP_CONCURRENCY = 100  # Max in-flight requests
+HTTP_PER_HOST_LIMIT = 4  # Be polite per country domain
+HTTP_FETCH_TIMEOUT = 15  # Seconds per request
+
+SELENIUM_WORKERS = os.cpu_count() or 1  # One Chrome per worker process
+
+# Pre-compiled regexes (clean/parse helpers run once per product)
+_RE_TRAILING = re.compile(r'\s*[\|\-]\s*(Glamira|Buy|Shop|Kaufen).*$', re.IGNORECASE)
+_RE_SPACES = re.compile(r'\s+')
+_RE_PRICE_STRIP = re.compile(r'[^\d,.]')
+_RE_RATING = re.compile(r'(\d+\.?\d*)')
+_RE_AMSTARS = re.compile('amstars-rating-container')
 
 
 # LOGGING
@@ -74,17 +104,20 @@ def setup_logging():
 
 
 # SELENIUM SETUP
-def setup_driver(headless=True):
+def setup_driver(headless=True, page_load_timeout=PAGE_LOAD_TIMEOUT, profile_name='main'):
     """Setup Chrome driver with anti-detection and performance settings"""
     chrome_options = Options()
-    
+
+    # Eager: return on DOMContentLoaded, don't wait for subresources
+    chrome_options.page_load_strategy = 'eager'
+
     # Anti-detection
     chrome_options.add_argument('--disable-blink-features=AutomationControlled')
     chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
     chrome_options.add_experimental_option('useAutomationExtension', False)
     
     # User agent
-    chrome_options.add_argument('user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
+    chrome_options.add_argument(f'user-agent={USER_AGENT}')
     
     # Headless mode
     if headless:
@@ -97,19 +130,44 @@ def setup_driver(headless=True):
     chrome_options.add_argument('--disable-software-rasterizer')
     chrome_options.add_argument('--disable-extensions')
     
-    # Speed up page load by disabling images (optional - comment out if needed)
-    # prefs = {"profile.managed_default_content_settings.images": 2}
-    # chrome_options.add_experimental_option("prefs", prefs)
+    # The crawler only scrapes text and reads src/content attributes, so
+    # skip downloading images/CSS/fonts entirely - most of the page bytes
+    prefs = {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.managed_default_content_settings.stylesheets": 2,
+        "profile.managed_default_content_settings.fonts": 2,
+        "profile.managed_default_content_settings.plugins": 2,
+        "profile.managed_default_content_settings.popups": 2,
+        "profile.managed_default_content_settings.media_stream": 2,
+    }
+    chrome_options.add_experimental_option("prefs", prefs)
+    chrome_options.add_argument('--blink-settings=imagesEnabled=false')
     
+    # Persistent profile: warm DNS, TLS session tickets and HTTP cache
+    # survive across runs and into the retry phase. Chrome locks a profile
+    # per process, so concurrent workers get distinct names - but the names
+    # are stable run to run so the caches are actually reused.
+    chrome_options.add_argument(f'--user-data-dir=/tmp/glamira_profile_{profile_name}')
+    chrome_options.add_argument('--disk-cache-size=1073741824')
+
     # Memory optimization
     chrome_options.add_argument('--disable-background-networking')
     chrome_options.add_argument('--disable-default-apps')
     chrome_options.add_argument('--disable-sync')
+
+    # Avoid background throttling stalls in headless mode
+    chrome_options.add_argument('--disable-background-timer-throttling')
+    chrome_options.add_argument('--disable-backgrounding-occluded-windows')
+    chrome_options.add_argument('--disable-renderer-backgrounding')
+    chrome_options.add_argument('--disable-ipc-flooding-protection')
+    chrome_options.add_argument('--disable-features=TranslateUI,BlinkGenPropertyTrees')
+    chrome_options.add_argument('--mute-audio')
+    chrome_options.add_argument('--hide-scrollbars')
     
     # Initialize driver
     service = Service(ChromeDriverManager().install())
     driver = webdriver.Chrome(service=service, options=chrome_options)
-    driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
+    driver.set_page_load_timeout(page_load_timeout)
     
     # Hide webdriver property
     driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
@@ -121,7 +179,16 @@ def setup_driver(headless=True):
 def connect_mongodb():
     """Connect to MongoDB"""
     try:
-        client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=5000)
+        client = MongoClient(
+            MONGODB_URI,
+            serverSelectionTimeoutMS=5000,
+            # Pool sized for the worker count; zstd/snappy shrink the big
+            # extract result on the wire (server picks what it supports)
+            maxPoolSize=SELENIUM_WORKERS * 2,
+            minPoolSize=SELENIUM_WORKERS,
+            compressors='zstd,snappy',
+            retryReads=True
+        )
         client.server_info()
         db = client[MONGODB_DATABASE]
         logging.info(f"Connected to MongoDB: {db.name}")
@@ -135,76 +202,82 @@ def extract_product_ids_from_mongodb(db):
     """Extract unique product_ids with URLs and domains from MongoDB"""
     
     logging.info("Extracting product data from summary collection...")
-    
+
     collection = db[MONGODB_COLLECTION]
-    product_data = {}
-    
-    for event_type in PRODUCT_EVENT_TYPES:
-        try:
-            logging.info(f"Processing event type: {event_type}")
-            
-            # Query documents with this event type
-            query = {'collection': event_type}
-            
-            # Handle product_view_all_recommend_clicked differently
-            if event_type == 'product_view_all_recommend_clicked':
-                docs = collection.find(query, {'viewing_product_id': 1, 'referrer_url': 1})
-                for doc in docs:
-                    product_id = doc.get('viewing_product_id')
-                    url = doc.get('referrer_url')
-                    
-                    if product_id:
-                        if product_id not in product_data:
-                            product_data[product_id] = {'product_id': product_id, 'urls': set()}
-                        if url:
-                            product_data[product_id]['urls'].add(url)
-            else:
-                # Other event types use product_id and current_url
-                docs = collection.find(query, {
-                    'product_id': 1, 
-                    'viewing_product_id': 1, 
-                    'current_url': 1
-                })
-                
-                for doc in docs:
-                    product_id = doc.get('product_id') or doc.get('viewing_product_id')
-                    url = doc.get('current_url')
-                    
-                    if product_id:
-                        if product_id not in product_data:
-                            product_data[product_id] = {'product_id': product_id, 'urls': set()}
-                        if url:
-                            product_data[product_id]['urls'].add(url)
-            
-            logging.info(f"  Found {len(product_data)} unique products so far")
-            
-        except Exception as e:
-            logging.error(f"Error processing event type {event_type}: {e}")
-    
-    # Convert to list and prioritize URLs
+
+    # Group server-side: only unique products (with deduped URL sets) cross
+    # the wire instead of every raw event document.
+    # product_view_all_recommend_clicked stores the id/url under
+    # viewing_product_id/referrer_url, which $ifNull handles uniformly.
+    pipeline = [
+        {'$match': {'collection': {'$in': PRODUCT_EVENT_TYPES}}},
+        {'$project': {
+            '_id': 0,
+            'pid': {'$ifNull': ['$product_id', '$viewing_product_id']},
+            'url': {'$ifNull': ['$current_url', '$referrer_url']}
+        }},
+        {'$match': {'pid': {'$ne': None}}},
+        {'$group': {'_id': '$pid', 'urls': {'$addToSet': '$url'}}}
+    ]
+
     product_list = []
-    for pid, data in product_data.items():
-        urls = list(data['urls'])
-        
-        # Prioritize SEO-friendly URLs over /catalog/product/view/id/
-        seo_urls = [u for u in urls if '/catalog/product/view/id/' not in u]
-        sample_url = seo_urls[0] if seo_urls else (urls[0] if urls else None)
-        
-        # Extract domain
-        domain = extract_domain_from_url(sample_url) if sample_url else None
-        
-        product_list.append({
-            'product_id': pid,
-            'url': sample_url,
-            'domain': domain
-        })
-    
+    try:
+        # Compound indexes covering the $match + $project fields so the
+        # extract runs as index seeks instead of a full collection scan
+        collection.create_index([('collection', 1), ('product_id', 1)], background=True)
+        collection.create_index([('collection', 1), ('viewing_product_id', 1)], background=True)
+
+        logging.info("Running aggregation pipeline...")
+        cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=5000)
+
+        # Deterministic URL choice: prefer the canonical glamira.com domain,
+        # then SEO-friendly paths over /catalog/product/view/id/, then
+        # lexicographic - $addToSet gives no stable order on its own
+        url_priority = lambda u: (
+            0 if 'glamira.com' in u else 1,
+            0 if '/catalog/product/view/id/' not in u else 1,
+            u
+        )
+
+        for doc in cursor:
+            urls = sorted((u for u in doc['urls'] if u), key=url_priority)
+            sample_url = urls[0] if urls else None
+
+            # Extract domain
+            domain = extract_domain_from_url(sample_url) if sample_url else None
+
+            product_list.append({
+                'product_id': doc['_id'],
+                'url': sample_url,
+                'domain': domain
+            })
+
+        # The same product often shows up under several country domains with
+        # an identical path; crawl each path once, keeping the lowest id
+        product_list.sort(key=lambda p: str(p['product_id']))
+        seen_paths = set()
+        deduped = []
+        for product in product_list:
+            path = urlparse(product['url']).path if product['url'] else None
+            if path and path in seen_paths:
+                continue
+            if path:
+                seen_paths.add(path)
+            deduped.append(product)
+
+        if len(deduped) < len(product_list):
+            logging.info(f"Deduplicated {len(product_list) - len(deduped)} cross-domain duplicates")
+        product_list = deduped
+    except Exception as e:
+        logging.error(f"Error extracting product data: {e}")
+        return []
+
     logging.info(f"Total unique products found: {len(product_list)}")
     
     # Save to file
     Path(OUTPUT_PRODUCT_IDS).parent.mkdir(parents=True, exist_ok=True)
-    with open(OUTPUT_PRODUCT_IDS, 'w', encoding='utf-8') as f:
-        json.dump(product_list, f, indent=2, ensure_ascii=False)
+    with open(OUTPUT_PRODUCT_IDS, 'wb') as f:
+        f.write(orjson.dumps(product_list, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
     
     logging.info(f"Saved product data to {OUTPUT_PRODUCT_IDS}")
     return product_list
@@ -236,7 +309,7 @@ def clean_text(text):
     """Clean and normalize text"""
     if not text:
         return None
-    text = re.sub(r'\s+', ' ', text.strip())
+    text = _RE_SPACES.sub(' ', text.strip())
     return text if text else None
 
 
@@ -248,11 +321,7 @@ def clean_product_name(name):
     name = clean_text(name)
     
     # Remove domain/site name
-    name = re.sub(r'\s*[\|\-]\s*Glamira.*$', '', name, flags=re.IGNORECASE)
-    name = re.sub(r'\s*[\|\-]\s*GLAMIRA.*$', '', name)
-    name = re.sub(r'\s*[\|\-]\s*Buy.*$', '', name, flags=re.IGNORECASE)
-    name = re.sub(r'\s*[\|\-]\s*Shop.*$', '', name, flags=re.IGNORECASE)
-    name = re.sub(r'\s*[\|\-]\s*Kaufen.*$', '', name, flags=re.IGNORECASE)
+    name = _RE_TRAILING.sub('', name)
     
     return name.strip() if name and len(name) > 2 else None
 
@@ -263,7 +332,7 @@ def parse_price(price_text):
         return None
     try:
         # Remove currency symbols and spaces
-        price_text = re.sub(r'[^\d,.]', '', price_text)
+        price_text = _RE_PRICE_STRIP.sub('', price_text)
         # Handle European format (1.234,56 -> 1234.56)
         if ',' in price_text and '.' in price_text:
             # European format: 1.234,56
@@ -287,7 +356,7 @@ def parse_rating(rating_text):
         return None
     try:
         # Extract numeric rating ("4.85 stars" -> 4.85)
-        match = re.search(r'(\d+\.?\d*)', rating_text)
+        match = _RE_RATING.search(rating_text)
         if match:
             return float(match.group(1))
     except:
@@ -299,8 +368,8 @@ def load_product_ids_from_file():
     """Load product IDs from file"""
     try:
         if Path(OUTPUT_PRODUCT_IDS).exists():
-            with open(OUTPUT_PRODUCT_IDS, 'r', encoding='utf-8') as f:
-                products = json.load(f)
+            with open(OUTPUT_PRODUCT_IDS, 'rb') as f:
+                products = orjson.loads(f.read())
             logging.info(f"Loaded {len(products)} products from file")
             return products
     except Exception as e:
@@ -308,44 +377,114 @@ def load_product_ids_from_file():
     return None
 
 
+# Append-only log of processed product ids: one id per line. Resuming
+# rebuilds the set from the log instead of re-serializing the whole list
+# into the JSON state every batch.
+_processed_log_file = None
+
+
+def _get_processed_log_file():
+    global _processed_log_file
+    if _processed_log_file is None:
+        Path(OUTPUT_PROCESSED_LOG).parent.mkdir(parents=True, exist_ok=True)
+        _processed_log_file = open(OUTPUT_PROCESSED_LOG, 'a')
+        atexit.register(close_processed_log)
+    return _processed_log_file
+
+
+def close_processed_log():
+    global _processed_log_file
+    if _processed_log_file is not None:
+        _processed_log_file.close()
+        _processed_log_file = None
+
+
+def mark_processed(state, product_id):
+    """Record a crawled product in the state set and the append-only log"""
+    # Normalize to str: the log reads back as strings, but Mongo ids can be
+    # int - mixed types would make every membership test miss on resume
+    product_id = str(product_id)
+    state['processed_products'].add(product_id)
+    state['processed_count'] += 1
+    _get_processed_log_file().write(f"{product_id}\n")
+
+
 def load_resume_state():
-    """Load resume state from file"""
+    """Load resume state (counts/failures from JSON, processed ids from log)"""
+    state = {'processed_products': set(), 'processed_count': 0, 'failed_products': []}
+
     try:
         if Path(OUTPUT_RESUME).exists():
-            with open(OUTPUT_RESUME, 'r') as f:
-                state = json.load(f)
+            with open(OUTPUT_RESUME, 'rb') as f:
+                saved = orjson.loads(f.read())
+            state['failed_products'] = saved.get('failed_products', [])
+
+        if Path(OUTPUT_PROCESSED_LOG).exists():
+            with open(OUTPUT_PROCESSED_LOG, 'r') as f:
+                state['processed_products'] = set(f.read().split())
+            state['processed_count'] = len(state['processed_products'])
+
+        if state['processed_count']:
             logging.info(f"Loaded resume state: {state['processed_count']} products already crawled")
-            return state
     except Exception as e:
         logging.error(f"Error loading resume state: {e}")
-    
-    return {'processed_products': [], 'processed_count': 0, 'failed_products': []}
+
+    return state
 
 
 def save_resume_state(state):
-    """Save resume state to file"""
+    """Save resume state to file (processed ids live in the append-only log)"""
     try:
+        _get_processed_log_file().flush()
         Path(OUTPUT_RESUME).parent.mkdir(parents=True, exist_ok=True)
-        with open(OUTPUT_RESUME, 'w') as f:
-            json.dump(state, f)
+        with open(OUTPUT_RESUME, 'wb') as f:
+            f.write(orjson.dumps({
+                'processed_count': state['processed_count'],
+                'failed_products': state['failed_products']
+            }))
     except Exception as e:
         logging.error(f"Error saving resume state: {e}")
 
 
+# Long-lived buffered BSON writer: one open file + 1MiB buffer instead of
+# an open/write/close syscall pair per product
+_bson_file = None
+
+
+def _get_bson_file():
+    global _bson_file
+    if _bson_file is None:
+        Path(OUTPUT_BSON).parent.mkdir(parents=True, exist_ok=True)
+        _bson_file = io.BufferedWriter(
+            open(OUTPUT_BSON, 'ab', buffering=0), buffer_size=1 << 20
+        )
+        atexit.register(close_bson_file)
+    return _bson_file
+
+
+def flush_bson_file():
+    """Flush the buffered BSON writer (called once per batch)"""
+    if _bson_file is not None:
+        _bson_file.flush()
+
+
+def close_bson_file():
+    global _bson_file
+    if _bson_file is not None:
+        _bson_file.close()
+        _bson_file = None
+
+
 def append_to_bson(product_data):
-    """Append product data to BSON file"""
+    """Append product data to the buffered BSON file"""
     try:
-        Path(OUTPUT_BSON).parent.mkdir(parents=True, exist_ok=True)
-        
-        with open(OUTPUT_BSON, 'ab') as f:
-            data_copy = product_data.copy()
-            # Convert datetime to ISO string
-            if 'crawled_at' in data_copy and isinstance(data_copy['crawled_at'], datetime):
-                data_copy['crawled_at'] = data_copy['crawled_at'].isoformat()
-            
-            bson_data = bson.BSON.encode(data_copy)
-            f.write(bson_data)
-        
+        # Convert datetime to ISO string in place - callers hand the dict
+        # over for good, so there is no need to copy it per product
+        if isinstance(product_data.get('crawled_at'), datetime):
+            product_data['crawled_at'] = product_data['crawled_at'].isoformat()
+
+        _get_bson_file().write(bson.BSON.encode(product_data))
+
         return True
     except Exception as e:
         logging.error(f"Error appending to BSON: {e}")
@@ -354,40 +493,17 @@ def append_to_bson(product_data):
 
 
 # CRAWLING FUNCTIONS
-def crawl_product_details(driver, product_id, url, domain):
-    """Crawl product details from URL using Selenium"""
-    
+def parse_product_page(product_id, url, domain, page_source):
+    """Parse product details out of raw page HTML (pure CPU, no I/O)"""
+
     try:
-        # Load page with timeout handling
-        try:
-            driver.get(url)
-        except TimeoutException:
-            # Page load timeout - try to work with partial content
-            logging.debug(f"Page load timeout for {product_id}, attempting to parse partial content")
-        except WebDriverException as e:
-            return None, f"WebDriver error: {str(e)[:100]}"
-        
-        # Wait for body to be present
-        try:
-            WebDriverWait(driver, ELEMENT_WAIT_TIMEOUT).until(
-                EC.presence_of_element_located((By.TAG_NAME, "body"))
-            )
-        except TimeoutException:
-            return None, "Page body not loaded (timeout)"
-        except Exception as e:
-            return None, f"Error waiting for page: {str(e)[:100]}"
-        
-        # Additional wait for JavaScript to load
-        time.sleep(3)
-        
-        # Get page source and parse with BeautifulSoup
-        page_source = driver.page_source
-        soup = BeautifulSoup(page_source, 'html.parser')
-        
+        # lxml is the C parser; html.parser spends tens of ms per ~500KB page
+        soup = BeautifulSoup(page_source, 'lxml')
+
         # Initialize result
         result = {
             'product_id': product_id,
-            'url': driver.current_url,
+            'url': url,
             'domain': domain,
             'crawled_at': datetime.utcnow()
         }
@@ -421,24 +537,20 @@ def crawl_product_details(driver, product_id, url, domain):
         # 3. Category (from breadcrumb)
         category = None
         category_path = None
-        breadcrumb = soup.find('div', class_='breadcrumbs')
-        if breadcrumb:
-            links = breadcrumb.find_all('a')
-            categories = [clean_text(link.get_text()) for link in links if link.get_text().strip()]
-            if categories:
-                category = categories[-1]  # Last item
-                category_path = ' > '.join(categories)
+        categories = [t for t in (clean_text(a.get_text()) for a in soup.select('div.breadcrumbs a')) if t]
+        if categories:
+            category = categories[-1]  # Last item
+            category_path = ' > '.join(categories)
         
         result['category'] = category
         result['category_path'] = category_path
         
         # 4. Main Image
         main_image = None
+        # One tree walk with comma-separated selectors instead of chained finds
         img_elem = (
-            soup.find('img', class_='main-image') or
-            soup.find('img', {'itemprop': 'image'}) or
-            soup.find('meta', property='og:image') or
-            soup.select_one('.product-image img')
+            soup.select_one('img.main-image, img[itemprop="image"], .product-image img') or
+            soup.find('meta', property='og:image')
         )
         if img_elem:
             main_image = img_elem.get('src') or img_elem.get('content') or img_elem.get('data-src')
@@ -458,22 +570,195 @@ def crawl_product_details(driver, product_id, url, domain):
         rating = None
         
         # Try amstars-rating-container (Glamira specific)
-        amstars = soup.find('div', class_=re.compile('amstars-rating-container'))
+        amstars = soup.find('div', class_=_RE_AMSTARS)
         if amstars:
             rating_raw = amstars.get('title', '')
             rating = parse_rating(rating_raw)
         
         result['rating_raw'] = rating_raw
         result['rating'] = rating
-        
+
         return result, None
-        
+
+    except Exception as e:
+        error_msg = str(e)
+        logging.debug(f"Error parsing {product_id}: {error_msg}")
+        return None, error_msg
+
+
+def crawl_product_details(driver, product_id, url, domain):
+    """Crawl product details from URL using Selenium (JS-heavy fallback)"""
+
+    try:
+        # Load page with timeout handling
+        try:
+            driver.get(url)
+        except TimeoutException:
+            # Page load timeout - try to work with partial content
+            logging.debug(f"Page load timeout for {product_id}, attempting to parse partial content")
+        except WebDriverException as e:
+            return None, f"WebDriver error: {str(e)[:100]}"
+
+        # Wait until actual product content is present instead of sleeping
+        # a blanket 3s after <body> shows up
+        try:
+            WebDriverWait(driver, ELEMENT_WAIT_TIMEOUT).until(
+                EC.presence_of_element_located(
+                    (By.CSS_SELECTOR, 'h1, span.price, meta[property="og:title"]')
+                )
+            )
+        except TimeoutException:
+            return None, "Product content not loaded (timeout)"
+        except Exception as e:
+            return None, f"Error waiting for page: {str(e)[:100]}"
+
+        return parse_product_page(product_id, driver.current_url, domain, driver.page_source)
+
     except Exception as e:
         error_msg = str(e)
         logging.debug(f"Error crawling {product_id}: {error_msg}")
         return None, error_msg
 
 
+# ASYNC HTTP-FIRST CRAWLING (Selenium only as fallback for JS pages)
+
+async def fetch_html(session, sem, url):
+    """Fetch one product page over plain HTTP"""
+    async with sem:
+        # Small stagger so a burst of tasks doesn't hit one host at once
+        await asyncio.sleep(random.uniform(0, 0.2))
+        timeout = aiohttp.ClientTimeout(total=HTTP_FETCH_TIMEOUT)
+        async with session.get(url, timeout=timeout) as response:
+            response.raise_for_status()
+            return await response.text()
+
+
+async def crawl_batch_async(products):
+    """Crawl a batch of products concurrently.
+
+    Returns (results, needs_selenium): parsed product dicts for pages that
+    render server-side, and the products that need the Selenium fallback
+    (fetch error or page without server-rendered product data).
+    """
+    sem = asyncio.Semaphore(HTTP_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit=HTTP_CONCURRENCY, limit_per_host=HTTP_PER_HOST_LIMIT)
+
+    results = []
+    needs_selenium = []
+
+    async with aiohttp.ClientSession(
+        connector=connector,
+        headers={'User-Agent': USER_AGENT}
+    ) as session:
+
+        async def crawl_one(product):
+            product_id = product['product_id']
+            url = product.get('url') or build_product_url(product_id, product.get('domain'))
+
+            try:
+                html = await fetch_html(session, sem, url)
+            except Exception as e:
+                logging.debug(f"HTTP fetch failed for {product_id}: {e}")
+                needs_selenium.append(product)
+                return
+
+            result, _ = parse_product_page(product_id, url, product.get('domain'), html)
+
+            if result and result.get('product_name'):
+                results.append(result)
+            else:
+                # Page likely needs JavaScript to render product data
+                needs_selenium.append(product)
+
+        await asyncio.gather(*(crawl_one(p) for p in products))
+
+    return results, needs_selenium
+
+
+# Per-domain pacing: consecutive hits to the same country site stay spaced
+# out, but products on different domains never wait for each other
+_domain_last_request = {}
+
+
+def _pace_domain(domain):
+    key = domain or 'glamira.com'
+    now = time.time()
+    wait = _domain_last_request.get(key, 0) + PER_DOMAIN_DELAY - now
+    if wait > 0:
+        time.sleep(wait)
+        now = time.time()
+    _domain_last_request[key] = now
+
+
+# Plain-HTTP attempt for the retry pass (the main pass is already
+# HTTP-first via aiohttp): a failed Selenium load is often just a slow
+# page that renders fine server-side, so try the light runtime first
+_http_session = None
+
+
+def _get_http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        _http_session.headers['User-Agent'] = USER_AGENT
+    return _http_session
+
+
+def try_requests_first(product_id, url, domain):
+    """Fetch and parse without Chrome; only trust a complete result"""
+    try:
+        resp = _get_http_session().get(url, timeout=HTTP_FETCH_TIMEOUT)
+        resp.raise_for_status()
+        result, _ = parse_product_page(product_id, resp.url, domain, resp.text)
+        if result and result.get('product_name') and result.get('price') is not None:
+            return result
+    except Exception as e:
+        logging.debug(f"requests fetch failed for {product_id}: {e}")
+    return None
+
+
+# SELENIUM PROCESS POOL (Selenium blocks a whole process per page load,
+# so the JS fallback runs one Chrome per worker process)
+
+_selenium_driver = None
+_selenium_profile = 'main'
+_selenium_nav_count = 0
+
+
+def _init_selenium_worker(worker_counter):
+    global _selenium_driver, _selenium_profile
+    # Claim a stable worker index so each process reuses the same Chrome
+    # profile (and its caches) on every run, without profile-lock clashes
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    _selenium_profile = f'worker{worker_index}'
+    _selenium_driver = setup_driver(headless=True, profile_name=_selenium_profile)
+    # Quit Chrome when the worker process exits, else the leaked browser
+    # keeps the profile's SingletonLock and the next run can't start.
+    # The lambda reads the global so it still works after a mid-run recycle
+    atexit.register(lambda: _selenium_driver and _selenium_driver.quit())
+
+
+def _crawl_one_selenium(product):
+    global _selenium_driver, _selenium_nav_count
+
+    product_id = product['product_id']
+    url = product.get('url') or build_product_url(product_id, product.get('domain'))
+
+    # Chrome slows down as its memory grows with navigations; recycle it
+    # periodically so late products don't crawl slower than early ones
+    _selenium_nav_count += 1
+    if _selenium_nav_count % DRIVER_RESTART_NAVIGATIONS == 0:
+        _selenium_driver.quit()
+        _selenium_driver = setup_driver(headless=True, profile_name=_selenium_profile)
+
+    _pace_domain(product.get('domain'))
+    result, error = crawl_product_details(_selenium_driver, product_id, url, product.get('domain'))
+
+    return product, url, result, error
+
+
 # MAIN CRAWLING
 
 def crawl_products():
@@ -509,9 +794,9 @@ def crawl_products():
         # Load resume state
         logging.info("\nStep 3: Checking resume state...")
         resume_state = load_resume_state()
-        processed_set = set(resume_state['processed_products'])
+        processed_set = resume_state['processed_products']
         
-        products_to_crawl = [p for p in products if p['product_id'] not in processed_set]
+        products_to_crawl = [p for p in products if str(p['product_id']) not in processed_set]
         
         logging.info(f"Total products: {len(products)}")
         logging.info(f"Already crawled: {len(processed_set)}")
@@ -521,80 +806,102 @@ def crawl_products():
             logging.info("All products already crawled!")
             return True
         
-        # Setup Selenium driver
-        logging.info("\nStep 4: Setting up Selenium driver...")
-        driver = setup_driver(headless=True)
-        logging.info("Chrome driver ready")
-        
-        # Crawl products
-        logging.info(f"\nStep 5: Crawling {len(products_to_crawl)} products...")
-        total_batches = (len(products_to_crawl) + BATCH_SIZE - 1) // BATCH_SIZE
-        
+        # Async HTTP-first pass: most product pages render name/price/meta
+        # server-side, so the Chrome overhead is only paid for the remainder
+        logging.info(f"\nStep 4: Crawling {len(products_to_crawl)} products (async HTTP first)...")
         start_time = time.time()
-        batch_num = 0
-        
-        for i in range(0, len(products_to_crawl), BATCH_SIZE):
-            batch_num += 1
-            batch = products_to_crawl[i:i + BATCH_SIZE]
-            
-            batch_start_time = time.time()
-            batch_success = 0
-            batch_failed = 0
-            
-            for product in batch:
-                product_id = product['product_id']
-                url = product.get('url')
-                domain = product.get('domain')
-                
-                # Use URL from MongoDB, fallback to constructed URL
-                if not url:
-                    url = build_product_url(product_id, domain)
-                
-                # Crawl product
-                result, error = crawl_product_details(driver, product_id, url, domain)
-                
-                if result:
-                    # Save to BSON
-                    append_to_bson(result)
-                    
-                    # Update state
-                    resume_state['processed_products'].append(product_id)
-                    resume_state['processed_count'] += 1
-                    batch_success += 1
-                else:
-                    # Track failed product
-                    resume_state['failed_products'].append({
-                        'product_id': product_id,
-                        'url': url,
-                        'domain': domain,
-                        'error': error
-                    })
-                    batch_failed += 1
-                    logging.warning(f"Failed: {product_id} | {error}")
-                
-                # Small delay between products
-                time.sleep(DELAY_BETWEEN_PRODUCTS)
-            
-            batch_time = time.time() - batch_start_time
-            avg_time = batch_time / len(batch) if batch else 0
-            progress_pct = (resume_state['processed_count'] / len(products)) * 100
-            
+
+        needs_selenium = []
+        http_success = 0
+        total_http_batches = (len(products_to_crawl) + HTTP_BATCH_SIZE - 1) // HTTP_BATCH_SIZE
+
+        for i in range(0, len(products_to_crawl), HTTP_BATCH_SIZE):
+            http_batch_num = i // HTTP_BATCH_SIZE + 1
+            http_batch = products_to_crawl[i:i + HTTP_BATCH_SIZE]
+
+            http_batch_start = time.time()
+            results, batch_needs_selenium = asyncio.run(crawl_batch_async(http_batch))
+
+            for result in results:
+                append_to_bson(result)
+                mark_processed(resume_state, result['product_id'])
+
+            http_success += len(results)
+            needs_selenium.extend(batch_needs_selenium)
+            # Flush crawled data before the state file claims the progress
+            flush_bson_file()
+            save_resume_state(resume_state)
+
             logging.info(
-                f"Batch {batch_num}/{total_batches} | "
-                f"Success: {batch_success}/{len(batch)} | "
-                f"Failed: {batch_failed} | "
-                f"Time: {batch_time:.1f}s | "
-                f"Avg: {avg_time:.1f}s/product | "
-                f"Progress: {resume_state['processed_count']}/{len(products)} ({progress_pct:.1f}%)"
+                f"HTTP batch {http_batch_num}/{total_http_batches} | "
+                f"Success: {len(results)}/{len(http_batch)} | "
+                f"Needs JS: {len(batch_needs_selenium)} | "
+                f"Time: {time.time() - http_batch_start:.1f}s"
             )
-            
-            # Save state after each batch
+
+        logging.info(f"HTTP pass done: {http_success} crawled, {len(needs_selenium)} need Selenium")
+
+        # Selenium fallback for the JS-heavy remainder: a process pool where
+        # each worker owns its own Chrome, results stream back unordered
+        if needs_selenium:
+            logging.info(f"\nStep 5: Crawling {len(needs_selenium)} JS-heavy pages "
+                         f"with {SELENIUM_WORKERS} Selenium workers...")
+
+            selenium_start = time.time()
+            selenium_success = 0
+            selenium_failed = 0
+            done = 0
+
+            worker_counter = multiprocessing.Value('i', 0)
+            pool = multiprocessing.Pool(SELENIUM_WORKERS, initializer=_init_selenium_worker,
+                                        initargs=(worker_counter,))
+            try:
+                for product, url, result, error in pool.imap_unordered(
+                    _crawl_one_selenium, needs_selenium, chunksize=4
+                ):
+                    done += 1
+
+                    if result:
+                        # Save to BSON
+                        append_to_bson(result)
+
+                        # Update state
+                        mark_processed(resume_state, product['product_id'])
+                        selenium_success += 1
+                    else:
+                        # Track failed product
+                        resume_state['failed_products'].append({
+                            'product_id': product['product_id'],
+                            'url': url,
+                            'domain': product.get('domain'),
+                            'error': error
+                        })
+                        selenium_failed += 1
+                        logging.warning(f"Failed: {product['product_id']} | {error}")
+
+                    # Save state every BATCH_SIZE results
+                    if done % BATCH_SIZE == 0:
+                        flush_bson_file()
+                        save_resume_state(resume_state)
+                        progress_pct = (resume_state['processed_count'] / len(products)) * 100
+                        logging.info(
+                            f"Selenium progress: {done}/{len(needs_selenium)} | "
+                            f"Success: {selenium_success} | "
+                            f"Failed: {selenium_failed} | "
+                            f"Avg: {(time.time() - selenium_start) / done:.1f}s/product | "
+                            f"Progress: {resume_state['processed_count']}/{len(products)} ({progress_pct:.1f}%)"
+                        )
+            finally:
+                # close+join instead of the context manager: __exit__ calls
+                # terminate(), which SIGTERMs the workers and leaves their
+                # Chromes running (holding the profile locks for next run)
+                pool.close()
+                pool.join()
+
+            flush_bson_file()
             save_resume_state(resume_state)
-            
-            # Delay between batches
-            if batch_num < total_batches:
-                time.sleep(DELAY_BETWEEN_BATCHES)
-        
+            logging.info(f"Selenium pass done: {selenium_success} crawled, {selenium_failed} failed")
+
         processing_time = time.time() - start_time
         
         # Retry failed products
@@ -605,33 +912,51 @@ def crawl_products():
             logging.info(f"\n{'='*70}")
             logging.info(f"RETRYING {len(failed_list)} FAILED PRODUCTS")
             logging.info(f"{'='*70}")
-            
+
+            # Fresh driver with a patient timeout: failures are mostly
+            # intermittent, and a Chrome degraded by the main pass would
+            # just compound them
+            if driver:
+                driver.quit()
+            driver = setup_driver(headless=True, page_load_timeout=RETRY_PAGE_LOAD_TIMEOUT,
+                                  profile_name='retry')
+
             retry_success = 0
             retry_still_failed = []
-            
+
             for idx, failed_product in enumerate(failed_list, 1):
                 product_id = failed_product['product_id']
                 url = failed_product.get('url')
                 domain = failed_product.get('domain')
-                
-                result, error = crawl_product_details(driver, product_id, url, domain)
-                
+
+                # Cheap requests attempt before paying for Chrome again
+                _pace_domain(domain)
+                result = try_requests_first(product_id, url, domain)
+                error = None
+
+                if not result:
+                    for attempt in range(MAX_RETRIES_PER_PRODUCT):
+                        if attempt:
+                            time.sleep(2 ** attempt)  # Exponential backoff
+                        _pace_domain(domain)
+                        result, error = crawl_product_details(driver, product_id, url, domain)
+                        if result:
+                            break
+
                 if result:
                     append_to_bson(result)
-                    resume_state['processed_products'].append(product_id)
-                    resume_state['processed_count'] += 1
+                    mark_processed(resume_state, product_id)
                     retry_success += 1
                 else:
                     retry_still_failed.append(failed_product)
                 
                 if idx % 20 == 0:
                     logging.info(f"Retry progress: {idx}/{len(failed_list)} ({retry_success} succeeded)")
-                
-                time.sleep(DELAY_BETWEEN_PRODUCTS)
-            
+
             logging.info(f"Retry complete: {retry_success}/{len(failed_list)} succeeded")
             
             resume_state['failed_products'] = retry_still_failed
+            flush_bson_file()
             save_resume_state(resume_state)
             
             retry_time = time.time() - retry_start
@@ -661,9 +986,11 @@ def crawl_products():
                 logging.warning(f"  ... and {len(final_failed) - 5} more")
         
         # Clear resume state
-        if Path(OUTPUT_RESUME).exists():
-            Path(OUTPUT_RESUME).unlink()
-            logging.info("Resume state cleared")
+        close_processed_log()
+        for state_file in (OUTPUT_RESUME, OUTPUT_PROCESSED_LOG):
+            if Path(state_file).exists():
+                Path(state_file).unlink()
+        logging.info("Resume state cleared")
         
         return True
         
@@ -673,6 +1000,7 @@ def crawl_products():
         
     finally:
         logging.info("\nCleaning up...")
+        close_bson_file()
         if driver:
             driver.quit()
         if client:
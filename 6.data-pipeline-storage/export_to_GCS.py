@@ -1,13 +1,16 @@
+import glob
 import logging
 import sys
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 from pathlib import Path
 from datetime import datetime
 import time
 
 from pymongo import MongoClient, errors
 from google.cloud import storage
-import pandas as pd
+from google.cloud.storage import transfer_manager
 import pyarrow as pa
 import pyarrow.parquet as pq
 
@@ -27,21 +30,30 @@ GCS_CREDENTIALS_PATH = './gcs-service-account-key.json'
 
 # Export Configuration
 BATCH_SIZE = 10000  # Số lượng document mỗi chunk
+SCHEMA_SAMPLE_SIZE = 2000  # Số document $sample để suy ra master schema
+PARQUET_ROW_GROUP_BYTES = 128 * 1024 * 1024  # Gom ~128 MiB trước mỗi lần write_table
 EXPORT_FORMAT = 'parquet'
 GCS_TARGET_PATH = 'data_in_parquet' # Thư mục trên GCS
+GCS_UPLOAD_WORKERS = 8 # Số file upload song song
+GCS_CHUNK_SIZE = 32 * 1024 * 1024 # 32 MiB mỗi chunk upload
+GCS_LARGE_FILE_THRESHOLD = 32 * 1024 * 1024 # File lớn hơn mức này upload theo chunk song song
+GCS_LARGE_FILE_CHUNK = 64 * 1024 * 1024 # 64 MiB mỗi part của multipart upload
 
 # === ĐÂY LÀ PHẦN THAY ĐỔI ===
 
 # Collections to export (Script sẽ tạo ra các file này)
+# ip_locations không còn ở đây: ip_processor.py ghi thẳng ra Parquet,
+# không import vào MongoDB nữa - export lại chỉ lấy data cũ trước migration
 COLLECTIONS_TO_EXPORT = [
-    'ip_locations',
     'product_details',
     'summary'
 ]
 
 # Local Parquet files to upload (File đã có sẵn, chỉ upload)
-LOCAL_PARQUET_FILES = [
-    './output/ip_locations.parquet',
+# Glob pattern: ip_processor.py ghi part file ip_locations_<n>.parquet
+# mỗi lần chạy, nên phải quét cả bộ part thay vì một đường dẫn cố định
+LOCAL_PARQUET_GLOBS = [
+    './output/ip_locations_*.parquet',
     './output/product_details.parquet',
     './output/summary.parquet'
 ]
@@ -92,7 +104,12 @@ def connect_to_mongo():
             username=MONGODB_USERNAME,
             password=MONGODB_PASSWORD,
             authSource=MONGODB_AUTH_SOURCE,
-            serverSelectionTimeoutMS=5000  # Timeout 5s
+            serverSelectionTimeoutMS=5000,  # Timeout 5s
+            # Nén wire protocol: cột text UTM/URL nén rất tốt, giảm ~3-5x
+            # số byte qua socket cho cursor scan lớn (cần pymongo[zstd])
+            compressors='zstd,snappy',
+            maxPoolSize=32,
+            socketTimeoutMS=600000  # Cursor chạy dài trên collection nhiều GB
         )
         # Kiểm tra kết nối
         client.server_info()
@@ -104,95 +121,153 @@ def connect_to_mongo():
         log.error(f"Failed to connect to MongoDB (Auth Failed): {err}")
         return None
 
+def stringify_forced_cols(docs):
+    """
+    Ép giá trị các cột FORCE_STRING_COLS về str ngay trong list dict.
+
+    from_pylist KHÔNG coerce int -> pa.string() (raise ArrowTypeError),
+    nên phải chuẩn hóa value trước khi build table: cột UTM/gclid trong
+    Mongo lúc int lúc str, một chunk lẫn int là đổ cả export.
+    """
+    for doc in docs:
+        for col in FORCE_STRING_COLS:
+            val = doc.get(col)
+            if val is not None and not isinstance(val, str):
+                doc[col] = str(val)
+    return docs
+
+def build_master_schema(sample_docs):
+    """
+    Suy ra master schema từ một mẫu document.
+
+    Các cột trong FORCE_STRING_COLS luôn là pa.string() trong schema: Mongo
+    lưu chúng không đồng nhất (lúc int, lúc str) và Arrow coerce về string
+    ngay trong C++ lúc build array - không còn astype/str() per value ở Python.
+    """
+    schema = pa.Table.from_pylist(sample_docs).schema
+
+    for col in FORCE_STRING_COLS:
+        idx = schema.get_field_index(col)
+        if idx != -1:
+            schema = schema.set(idx, pa.field(col, pa.string()))
+        else:
+            # Cột sparse có thể không xuất hiện trong $sample nhưng vẫn phải
+            # nằm trong schema, nếu không from_pylist sẽ drop nó ở batch sau
+            schema = schema.append(pa.field(col, pa.string()))
+
+    return schema
+
+def probe_master_schema(collection):
+    """
+    Probe master schema MỘT LẦN bằng $sample trước khi chạy cursor chính.
+
+    Sample ngẫu nhiên ổn định hơn là suy từ batch 1 (batch 1 có thể chứa
+    cột toàn null -> suy sai kiểu). Trả về None nếu collection rỗng.
+    """
+    sample_docs = list(collection.aggregate([{'$sample': {'size': SCHEMA_SAMPLE_SIZE}}]))
+    for doc in sample_docs:
+        doc.pop('_id', None)
+
+    if not sample_docs:
+        return None
+
+    # Ép cột forced-string TRƯỚC khi infer: $sample lẫn int/str trong các
+    # cột này sẽ làm from_pylist crash ngay lúc suy schema
+    try:
+        return build_master_schema(stringify_forced_cols(sample_docs))
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        # Cột hỗn hợp kiểu ngoài FORCE_STRING_COLS -> báo rõ để thêm vào list
+        logging.getLogger().error(
+            f"Schema inference failed ({e}); a column outside "
+            f"FORCE_STRING_COLS likely mixes types - add it to the list"
+        )
+        raise
+
 def export_collection_to_parquet_chunked(db_client, collection_name, output_path):
     """
     Xuất một collection từ MongoDB ra file Parquet theo từng chunk.
-    
-    (CẬP NHẬT "MASTER SCHEMA": Giải quyết lỗi schema không nhất quán)
+
+    (CẬP NHẬT "ARROW TRỰC TIẾP": Bỏ hẳn vòng pandas DataFrame + astype/to_numeric.
+    Build Arrow table thẳng từ list dict bằng pa.Table.from_pylist — schema
+    enforce kiểu dữ liệu ngay lúc build, không cần dọn dẹp từng cột nữa)
     """
     log = logging.getLogger()
     log.info(f"Starting chunked export for collection: {collection_name}")
-    
-    FORCE_STRING_COLS = ['utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'gclid']
 
     collection = db_client[MONGODB_DATABASE][collection_name]
     Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-    
+
     writer = None
-    master_schema = None  # <--- THÊM BIẾN NÀY
-    chunk = []
     total_docs = 0
-    
+
     try:
+        # Probe schema trước, mở writer trước vòng lặp chính
+        master_schema = probe_master_schema(collection)
+        if master_schema is None:
+            log.warning(f"Collection {collection_name} is empty. No file created.")
+            return False
+
+        # ZSTD nén tốt hơn Snappy ~20-40% trên cột text UTM/URL,
+        # dictionary encoding gom các string cardinality thấp
+        writer = pq.ParquetWriter(
+            output_path,
+            master_schema,
+            compression='zstd',
+            compression_level=3,
+            use_dictionary=True,
+            data_page_size=2 * 1024 * 1024,
+            write_statistics=True,
+            version='2.6'
+        )
+
+        # Buffer nhiều chunk Arrow rồi mới write -> row group lớn,
+        # BigQuery prune tốt hơn theo footer stats
+        pending_tables = []
+        pending_bytes = 0
+
+        # Một chỗ duy nhất cho logic build + buffer + flush, dùng chung cho
+        # vòng lặp chính và chunk cuối (trước đây bị duplicate 2 nơi)
+        def flush_pending():
+            nonlocal pending_bytes
+            if pending_tables:
+                writer.write_table(pa.concat_tables(pending_tables))
+                pending_tables.clear()
+                pending_bytes = 0
+
+        def buffer_chunk(chunk):
+            nonlocal pending_bytes
+            # Arrow tự xử lý key thiếu thành null; riêng value int trong cột
+            # string thì phải tự ép trước vì from_pylist không coerce
+            table = pa.Table.from_pylist(stringify_forced_cols(chunk), schema=master_schema)
+            pending_tables.append(table)
+            pending_bytes += table.nbytes
+            if pending_bytes >= PARQUET_ROW_GROUP_BYTES:
+                flush_pending()
+
         with db_client.start_session() as session:
-            cursor = collection.find({}, no_cursor_timeout=True, session=session)
-            
-            for doc in cursor:
-                doc.pop('_id', None)
-                chunk.append(doc)
-                
-                if len(chunk) >= BATCH_SIZE:
-                    df = pd.DataFrame(chunk)
-                    
-                    # === Logic dọn dẹp kiểu dữ liệu (Giữ nguyên) ===
-                    for col in FORCE_STRING_COLS:
-                        if col in df.columns:
-                            df[col] = df[col].astype(str)
-                    
-                    for col in df.columns:
-                        if df[col].dtype == 'object':
-                            if col not in FORCE_STRING_COLS:
-                                try:
-                                    df[col] = pd.to_numeric(df[col], errors='raise')
-                                except (ValueError, TypeError):
-                                    df[col] = df[col].astype(str)
-                    # === Hết logic dọn dẹp ===
-                        
-                    
-                    # === LOGIC SCHEMA MỚI ===
-                    if writer is None: # Đây là Batch 1
-                        table = pa.Table.from_pandas(df, preserve_index=False)
-                        writer = pq.ParquetWriter(output_path, table.schema)
-                        master_schema = table.schema # <--- LƯU SCHEMA "CHUẨN"
-                    else: # Đây là Batch 2, 3...
-                        # Ép batch này tuân theo schema chuẩn
-                        table = pa.Table.from_pandas(df, preserve_index=False, schema=master_schema) # <--- SỬ DỤNG SCHEMA
-                    # === HẾT LOGIC MỚI ===
-
-                    writer.write_table(table)
-                    total_docs += len(chunk)
-                    log.info(f"  ... exported {total_docs} docs from {collection_name}")
-                    chunk = []
-
-            # Xử lý chunk cuối cùng (nếu còn)
-            if chunk:
-                df = pd.DataFrame(chunk)
-
-                # === Logic dọn dẹp kiểu dữ liệu (Lặp lại) ===
-                for col in FORCE_STRING_COLS:
-                    if col in df.columns:
-                        df[col] = df[col].astype(str)
-                
-                for col in df.columns:
-                    if df[col].dtype == 'object':
-                        if col not in FORCE_STRING_COLS:
-                            try:
-                                df[col] = pd.to_numeric(df[col], errors='raise')
-                            except (ValueError, TypeError):
-                                df[col] = df[col].astype(str)
-                # === Hết logic dọn dẹp ===
-
-                # === LOGIC SCHEMA MỚI (Lặp lại) ===
-                if writer is None: # Đây là batch DUY NHẤT
-                    table = pa.Table.from_pandas(df, preserve_index=False)
-                    writer = pq.ParquetWriter(output_path, table.schema)
-                else: # Đây là batch cuối cùng (không phải đầu tiên)
-                    table = pa.Table.from_pandas(df, preserve_index=False, schema=master_schema) # <--- SỬ DỤNG SCHEMA
-                # === HẾT LOGIC MỚI ===
-
-                writer.write_table(table)
+            # Loại _id ngay phía server + batch_size lớn để giảm số getMore round-trip
+            cursor = collection.find(
+                {},
+                projection={'_id': 0},
+                no_cursor_timeout=True,
+                session=session,
+                batch_size=BATCH_SIZE
+            )
+
+            # list(islice(...)) gom mỗi batch trong C-level loop,
+            # bỏ hẳn 1 lần append + branch Python cho từng document
+            while True:
+                chunk = list(islice(cursor, BATCH_SIZE))
+                if not chunk:
+                    break
+
+                buffer_chunk(chunk)
                 total_docs += len(chunk)
-                log.info(f"  ... finished exporting {total_docs} docs from {collection_name}")
+                log.info(f"  ... exported {total_docs} docs from {collection_name}")
+
+            # Flush phần buffer còn lại
+            flush_pending()
+            log.info(f"  ... finished exporting {total_docs} docs from {collection_name}")
             
             if total_docs == 0:
                 log.warning(f"Collection {collection_name} is empty. No file created.")
@@ -222,7 +297,11 @@ def upload_file_to_gcs(bucket, local_path, gcs_path):
     
     try:
         blob = bucket.blob(gcs_path)
-        blob.upload_from_filename(local_path)
+        # File parquet đã nén sẵn (zstd) -> tắt gzip phía client,
+        # crc32c rẻ hơn md5 (có hardware acceleration)
+        blob.content_encoding = None
+        blob.content_type = 'application/octet-stream'
+        blob.upload_from_filename(local_path, checksum='crc32c')
         log.info(f"Successfully uploaded to {gcs_path}")
         return gcs_path, file_size_mb
     except Exception as e:
@@ -268,36 +347,95 @@ def main():
     Path(TEMP_DIR).mkdir(parents=True, exist_ok=True)
     
     local_files_from_export = [] # Danh sách file vừa export để upload
-    
-    for collection_name in COLLECTIONS_TO_EXPORT:
-        local_path = Path(TEMP_DIR) / f"{collection_name}.{EXPORT_FORMAT}"
-        
-        try:
-            success = export_collection_to_parquet_chunked(
-                mongo_client, 
-                collection_name, 
+
+    # Export song song các collection: mỗi cursor PyMongo nhả GIL khi chờ I/O,
+    # MongoClient thread-safe và tự quản lý connection pool, mỗi export ghi
+    # file Parquet riêng nên không tranh chấp gì
+    with ThreadPoolExecutor(max_workers=len(COLLECTIONS_TO_EXPORT)) as executor:
+        future_to_export = {}
+        for collection_name in COLLECTIONS_TO_EXPORT:
+            local_path = Path(TEMP_DIR) / f"{collection_name}.{EXPORT_FORMAT}"
+            future = executor.submit(
+                export_collection_to_parquet_chunked,
+                mongo_client,
+                collection_name,
                 str(local_path)
             )
-            
-            if success: # Chỉ thêm nếu file được tạo (không rỗng)
-                local_files_from_export.append(str(local_path))
-        except Exception as e:
-            log.error(f"Error exporting collection {collection_name}: {e}", exc_info=True)
+            future_to_export[future] = (collection_name, str(local_path))
+
+        for future in as_completed(future_to_export):
+            collection_name, local_path = future_to_export[future]
+            try:
+                if future.result(): # Chỉ thêm nếu file được tạo (không rỗng)
+                    local_files_from_export.append(local_path)
+            except Exception as e:
+                log.error(f"Error exporting collection {collection_name}: {e}", exc_info=True)
 
     mongo_client.close()
 
     # === THAY ĐỔI CHÍNH NẰM Ở ĐÂY ===
-    # Step 4: Uploading local Parquet files
+    # Step 4: Uploading local Parquet files (song song qua transfer_manager)
     log.info("\nStep 4: Uploading all local Parquet files...")
-    
-    # Gộp 2 danh sách: file vừa export + file đã có sẵn
-    all_files_to_upload = local_files_from_export + LOCAL_PARQUET_FILES
+
+    # Gộp 2 danh sách: file vừa export + file đã có sẵn (expand glob để
+    # lấy đủ bộ part ip_locations_<n>.parquet của ip_processor.py)
+    local_parquet_files = []
+    for pattern in LOCAL_PARQUET_GLOBS:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            log.warning(f"No local file matches {pattern}, skipping")
+        local_parquet_files.extend(matches)
+
+    all_files_to_upload = local_files_from_export + local_parquet_files
     log.info(f"Found {len(all_files_to_upload)} total files to upload.")
-    
+
+    upload_pairs = []
+    large_pairs = []
     for local_path in all_files_to_upload:
-        file_name = Path(local_path).name
-        gcs_path = f"{GCS_TARGET_PATH}/{file_name}"
-        
+        local_file = Path(local_path)
+        if not local_file.exists():
+            log.warning(f"Local file not found, skipping: {local_path}")
+            continue
+
+        blob = gcs_bucket.blob(f"{GCS_TARGET_PATH}/{local_file.name}")
+        # Parquet đã nén sẵn -> không để client gzip thêm lần nữa
+        blob.content_encoding = None
+        blob.content_type = 'application/octet-stream'
+        if local_file.stat().st_size >= GCS_LARGE_FILE_THRESHOLD:
+            # File lớn: cắt thành part 64 MiB upload song song, GCS ghép
+            # phía server -> overlap đọc disk với network trong 1 file
+            large_pairs.append((local_path, blob))
+        else:
+            blob.chunk_size = GCS_CHUNK_SIZE # Chunk lớn -> ít request hơn mỗi stream
+            upload_pairs.append((local_path, blob))
+
+    results = list(transfer_manager.upload_many(
+        upload_pairs,
+        max_workers=GCS_UPLOAD_WORKERS,
+        raise_exception=False
+    ))
+
+    for local_path, blob in large_pairs:
+        try:
+            transfer_manager.upload_chunks_concurrently(
+                local_path,
+                blob,
+                chunk_size=GCS_LARGE_FILE_CHUNK,
+                max_workers=GCS_UPLOAD_WORKERS
+            )
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+
+    for (local_path, blob), result in zip(upload_pairs + large_pairs, results):
+        file_size = Path(local_path).stat().st_size / (1024 * 1024)
+
+        if isinstance(result, Exception):
+            log.error(f"Failed to upload {local_path}: {result}")
+            continue
+
+        log.info(f"Successfully uploaded {local_path} ({file_size:.2f} MB) to gs://{GCS_BUCKET_NAME}/{blob.name}")
+
         # Xác định nguồn
         source_collection = Path(local_path).stem
         if local_path in local_files_from_export:
@@ -305,15 +443,13 @@ def main():
         else:
             source_type = "pre-converted"
 
-        uploaded_path, file_size = upload_file_to_gcs(gcs_bucket, local_path, gcs_path)
-        if uploaded_path:
-            exported_files_manifest.append({
-                "path": gcs_path, 
-                "size_mb": file_size, 
-                "source_collection": source_collection,
-                "source_type": source_type
-            })
-            total_files_exported += 1
+        exported_files_manifest.append({
+            "path": blob.name,
+            "size_mb": file_size,
+            "source_collection": source_collection,
+            "source_type": source_type
+        })
+        total_files_exported += 1
     # === HẾT THAY ĐỔI ===
 
     # Step 5: Creating export manifest